@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import os
-import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from pathlib import Path
+import threading
+import orjson
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, unquote, quote
 import urllib.parse
 from datetime import datetime
@@ -11,45 +11,107 @@ VIDEO_DIR = "/videos"
 STATUS_FILE = "/videos/.conversion_status.json"
 PORT = 8181
 
+# Расширения отдаваемых видео (кортеж для str.endswith)
+VIDEO_EXT_TUPLE = ('.mp4',)
+
+# Кэш сериализованного списка видео, инвалидируется при изменении сигнатуры дерева
+_CACHE = {'signature': None, 'payload': b''}
+_CACHE_LOCK = threading.Lock()
+
+_UNITS = ('Б', 'КБ', 'МБ', 'ГБ', 'ТБ', 'ПБ')
+
 def format_file_size(size_bytes):
     """Форматировать размер файла в читаемый вид"""
-    for unit in ['Б', 'КБ', 'МБ', 'ГБ', 'ТБ']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.1f} ПБ"
+    if size_bytes < 1024:
+        return f"{size_bytes:.1f} Б"
+    # Индекс единицы измерения по количеству бит, без цикла делений
+    i = min((size_bytes.bit_length() - 1) // 10, 5)
+    return f"{size_bytes / (1 << (10 * i)):.1f} {_UNITS[i]}"
 
-def get_video_files(directory):
-    """Получить список видеофайлов с метаданными"""
-    video_files = []
+def iter_videos(directory, exts):
+    """Рекурсивно обойти директорию через os.scandir и вернуть (путь, DirEntry) видеофайлов"""
+    stack = [directory]
+    while stack:
+        top = stack.pop()
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file() and entry.name.lower().endswith(exts):
+                            yield entry.path, entry
+                    except OSError:
+                        continue
+        except OSError:
+            # Пропускаем директории, к которым нет доступа
+            continue
+
+def iter_video_files(directory):
+    """Лениво выдавать метаданные видеофайлов (без сортировки)"""
     if not os.path.exists(directory):
-        return video_files
-    
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if Path(file).suffix.lower() == '.mp4':
-                file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(file_path, directory)
-                
-                try:
-                    stat = os.stat(file_path)
-                    file_size = stat.st_size
-                    mtime = stat.st_mtime
-                    
-                    video_files.append({
-                        'name': relative_path,
-                        'size': file_size,
-                        'size_formatted': format_file_size(file_size),
-                        'date': datetime.fromtimestamp(mtime).isoformat(),
-                        'date_formatted': datetime.fromtimestamp(mtime).strftime('%d.%m.%Y %H:%M'),
-                        'format': Path(file).suffix.lower().replace('.', '').upper()
-                    })
-                except OSError:
-                    # Пропускаем файлы, к которым нет доступа
-                    continue
+        return
     
-    # Сортируем по дате (новые сначала)
-    return sorted(video_files, key=lambda x: x['date'], reverse=True)
+    for file_path, entry in iter_videos(directory, VIDEO_EXT_TUPLE):
+        relative_path = os.path.relpath(file_path, directory)
+        name = entry.name
+        suffix = name[name.rfind('.'):].lower()
+        
+        try:
+            # DirEntry кэширует результат stat
+            stat = entry.stat()
+            file_size = stat.st_size
+            dt = datetime.fromtimestamp(stat.st_mtime)
+            
+            yield {
+                'name': relative_path,
+                'size': file_size,
+                'size_formatted': format_file_size(file_size),
+                'date': dt.isoformat(),
+                'date_formatted': dt.strftime('%d.%m.%Y %H:%M'),
+                'format': suffix[1:].upper()
+            }
+        except OSError:
+            # Пропускаем файлы, к которым нет доступа
+            continue
+
+def get_tree_signature(directory):
+    """Получить сигнатуру дерева по mtime поддиректорий и mtime/размеру видеофайлов"""
+    signature = 0
+    stack = [directory]
+    while stack:
+        top = stack.pop()
+        try:
+            signature ^= hash((top, os.stat(top).st_mtime_ns))
+            with os.scandir(top) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file() and entry.name.lower().endswith(VIDEO_EXT_TUPLE):
+                            # Файл может быть перезаписан на месте без изменения mtime директории
+                            stat = entry.stat()
+                            signature ^= hash((entry.path, stat.st_mtime_ns, stat.st_size))
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return signature
+
+def get_videos_payload(directory):
+    """Получить JSON со списком видео, используя кэш, пока дерево не изменилось"""
+    with _CACHE_LOCK:
+        signature = get_tree_signature(directory)
+        if _CACHE['signature'] != signature:
+            # Сериализуем каждую запись сразу, чтобы не держать в памяти список словарей
+            # вместе с итоговым буфером; для сортировки (новые сначала) храним только дату
+            entries = sorted(
+                ((video['date'], orjson.dumps(video)) for video in iter_video_files(directory)),
+                key=lambda x: x[0], reverse=True
+            )
+            _CACHE['payload'] = b'[' + b','.join(entry for _, entry in entries) + b']'
+            _CACHE['signature'] = signature
+        return _CACHE['payload']
 
 class VideoAPIHandler(BaseHTTPRequestHandler):
     def do_HEAD(self):
@@ -63,22 +125,18 @@ class VideoAPIHandler(BaseHTTPRequestHandler):
     def _handle_request(self, send_body=True):
         # Обрабатываем /videos и /api/videos (через прокси)
         if self.path == '/videos' or self.path == '/videos/' or self.path == '/api/videos' or self.path == '/api/videos/':
+            payload = get_videos_payload(VIDEO_DIR)
+            
             self.send_response(200)
             self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
             
-            videos = get_video_files(VIDEO_DIR)
-            response = json.dumps(videos, ensure_ascii=False)
             if send_body:
-                self.wfile.write(response.encode('utf-8'))
+                self.wfile.write(payload)
         elif self.path == '/status' or self.path == '/status/' or self.path == '/api/status' or self.path == '/api/status/':
             # Возвращаем статус конвертации
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
             status = {
                 "active": False,
                 "current_file": None,
@@ -90,16 +148,24 @@ class VideoAPIHandler(BaseHTTPRequestHandler):
             
             if os.path.exists(STATUS_FILE):
                 try:
-                    with open(STATUS_FILE, 'r', encoding='utf-8') as f:
-                        status = json.load(f)
+                    with open(STATUS_FILE, 'rb') as f:
+                        status = orjson.loads(f.read())
                 except:
                     pass
             
-            response = json.dumps(status, ensure_ascii=False)
+            payload = orjson.dumps(status)
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            
             if send_body:
-                self.wfile.write(response.encode('utf-8'))
+                self.wfile.write(payload)
         else:
             self.send_response(404)
+            self.send_header('Content-Length', '0')
             self.end_headers()
     
     def log_message(self, format, *args):
@@ -107,7 +173,7 @@ class VideoAPIHandler(BaseHTTPRequestHandler):
         pass
 
 def main():
-    server = HTTPServer(('0.0.0.0', PORT), VideoAPIHandler)
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), VideoAPIHandler)
     print(f"API сервер запущен на порту {PORT}")
     print(f"Сканирование директории: {VIDEO_DIR}")
     server.serve_forever()
@@ -3,9 +3,8 @@ import os
 import sys
 import subprocess
 import time
-import json
-import threading
-from pathlib import Path
+import concurrent.futures
+import orjson
 
 # Отключаем буферизацию вывода для корректного логирования в Docker
 sys.stdout.reconfigure(line_buffering=True)
@@ -14,12 +13,69 @@ sys.stderr.reconfigure(line_buffering=True)
 INPUT_DIR = "/input"
 OUTPUT_DIR = "/output"
 STATUS_FILE = "/output/.conversion_status.json"
+META_FILE = "/output/.vs_meta.json"
 SCAN_INTERVAL = 60  # секунд
+METADATA_WORKERS = 32  # потоков для проверки метаданных
+
+# xattr-ы для кэширования длительности видео
+DURATION_XATTR = 'user.vs.duration'
+MTIME_XATTR = 'user.vs.mtime_ns'
 
 # Поддерживаемые видео форматы
 VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm', '.m4v', '.3gp', '.ogv'}
+VIDEO_EXT_TUPLE = tuple(VIDEO_EXTENSIONS)
+
+# Ключи из вывода ffmpeg -progress, которые используются для расчета прогресса
+PROGRESS_KEYS = (b'out_time_ms=', b'speed=', b'progress=')
+PROGRESS_READ_SIZE = 65536
+
+# Шаблоны команд ffmpeg; INPUT_ARG и OUTPUT_ARG подменяются путями в build_cmd
+INPUT_ARG = '{input}'
+OUTPUT_ARG = '{output}'
 
-# Глобальный статус конвертации
+# Правильное использование QSV для HEVC 4K HDR -> H.264 SDR
+# Декодируем HEVC через QSV, масштабируем через scale_qsv, кодируем h264_qsv
+QSV_CMD_TMPL = (
+    'ffmpeg',
+    '-init_hw_device', 'qsv=hw:/dev/dri/renderD128',  # Инициализируем QSV устройство
+    '-filter_hw_device', 'hw',  # Указываем устройство для фильтров
+    '-hwaccel', 'qsv',  # Аппаратное декодирование HEVC через QSV
+    '-hwaccel_output_format', 'qsv',
+    '-i', INPUT_ARG,
+    '-vf', 'hwupload=extra_hw_frames=64,scale_qsv=1920:1080:format=nv12',  # Масштабирование через QSV (4K -> 1080p, убираем HDR)
+    '-c:v', 'h264_qsv',
+    '-global_quality', '23',  # Качество для QSV (0-51, меньше = лучше)
+    '-profile:v', 'high',
+    '-level', '4.2',  # Уровень для поддержки 1080p
+    '-c:a', 'aac',
+    '-b:a', '192k',
+    '-movflags', '+faststart',
+    '-y',
+    '-progress', 'pipe:1',
+    '-loglevel', 'warning',
+    OUTPUT_ARG
+)
+
+SW_CMD_TMPL = (
+    'ffmpeg',
+    '-i', INPUT_ARG,
+    '-c:v', 'libx264',           # Видеокодек H.264
+    '-preset', 'medium',          # Баланс скорости/качества
+    '-crf', '23',                 # Качество (18-28, меньше = лучше)
+    '-c:a', 'aac',                # Аудиокодек AAC
+    '-b:a', '192k',               # Битрейт аудио
+    '-movflags', '+faststart',    # Быстрый старт для веб-плееров
+    '-pix_fmt', 'yuv420p',        # Совместимость с браузерами
+    '-profile:v', 'high',         # Профиль H.264
+    '-level', '4.0',              # Уровень H.264
+    '-y',                         # Перезаписать выходной файл
+    '-progress', 'pipe:1',        # Вывод прогресса в stdout
+    '-loglevel', 'error',         # Минимальный вывод логов
+    OUTPUT_ARG
+)
+
+# Глобальный статус конвертации. Словарь не изменяется на месте: update_status
+# подменяет ссылку на новый словарь, поэтому читатели берут снимок без блокировки
 conversion_status = {
     "active": False,
     "current_file": None,
@@ -29,33 +85,73 @@ conversion_status = {
     "status": "idle",
     "method": None  # "qsv" или "software"
 }
-status_lock = threading.Lock()
+_last_save = 0.0
+STATUS_SAVE_INTERVAL = 0.25  # секунд между записями статуса во время конвертации
+
+# Sidecar-кэш длительностей {путь входного файла: метаданные}, загружается лениво
+_meta = None
 
-def save_status():
+# Результат проверки Quick Sync (None — еще не определен)
+_qsv_available = None
+
+def save_status(force=False):
     """Сохранить статус в файл"""
+    global _last_save
     try:
-        with status_lock:
-            with open(STATUS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(conversion_status, f, ensure_ascii=False, indent=2)
+        snapshot = conversion_status
+        now = time.monotonic()
+        # Во время конвертации не пишем статус чаще STATUS_SAVE_INTERVAL
+        if not force and snapshot['status'] == 'converting' and now - _last_save < STATUS_SAVE_INTERVAL:
+            return
+        _last_save = now
+        data = orjson.dumps(snapshot, option=orjson.OPT_INDENT_2)
+        # Пишем во временный файл и атомарно подменяем, чтобы api не прочитал файл частично
+        tmp_path = STATUS_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, STATUS_FILE)
     except Exception as e:
         print(f"Ошибка сохранения статуса: {e}", flush=True)
 
-def update_status(**kwargs):
+def update_status(force=False, **kwargs):
     """Обновить статус конвертации"""
-    with status_lock:
-        conversion_status.update(kwargs)
-    save_status()
+    global conversion_status
+    conversion_status = {**conversion_status, **kwargs}
+    save_status(force=force)
+
+def scan_files(directory, exts):
+    """Рекурсивно обойти директорию через os.scandir и вернуть DirEntry файлов с нужными расширениями"""
+    stack = [directory]
+    while stack:
+        top = stack.pop()
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    try:
+                        # follow_symlinks=True — обходим вложенные каталоги, даже если это symlink-и
+                        if entry.is_dir(follow_symlinks=True):
+                            stack.append(entry.path)
+                        elif entry.is_file() and entry.name.lower().endswith(exts):
+                            yield entry
+                    except OSError:
+                        continue
+        except OSError:
+            continue
 
 def get_video_files(directory):
-    """Получить список видеофайлов в директории (учитывая symlink-и)"""
-    video_files = []
-    # followlinks=True — обходим вложенные каталоги, даже если это symlink-и
-    for root, dirs, files in os.walk(directory, followlinks=True):
-        for file in files:
-            if Path(file).suffix.lower() in VIDEO_EXTENSIONS:
-                video_files.append(os.path.join(root, file))
-    # Сортируем по алфавиту
-    return sorted(video_files)
+    """Получить видеофайлы в директории (учитывая symlink-и)"""
+    for entry in scan_files(directory, VIDEO_EXT_TUPLE):
+        yield entry.path
+
+def get_output_index(directory):
+    """Получить mtime_ns всех уже сконвертированных файлов одним обходом директории"""
+    out_index = {}
+    for entry in scan_files(directory, ('.mp4',)):
+        try:
+            out_index[entry.path] = entry.stat().st_mtime_ns
+        except OSError:
+            continue
+    return out_index
 
 def get_output_path(input_path):
     """Получить путь к выходному файлу"""
@@ -65,47 +161,32 @@ def get_output_path(input_path):
     base_name = os.path.splitext(output_path)[0]
     return base_name + '.mp4'
 
-def needs_conversion(input_path, output_path):
+def needs_conversion(input_path, output_path, out_index=None):
     """Проверить, нужна ли конвертация"""
-    if not os.path.exists(output_path):
-        return True
+    # out_index ({путь выходного файла: mtime_ns} из get_output_index) избавляет от stat выходного файла
+    if out_index is not None:
+        output_mtime_ns = out_index.get(output_path)
+        if output_mtime_ns is None:
+            return True
+    else:
+        try:
+            output_mtime_ns = os.stat(output_path).st_mtime_ns
+        except FileNotFoundError:
+            return True
     
     # Проверяем, что выходной файл новее входного
-    input_mtime = os.path.getmtime(input_path)
-    output_mtime = os.path.getmtime(output_path)
-    return input_mtime > output_mtime
+    return os.stat(input_path).st_mtime_ns > output_mtime_ns
 
 def parse_ffmpeg_progress(line):
-    """Парсить строку прогресса ffmpeg"""
-    if '=' not in line:
-        return None
-    try:
-        key, value = line.strip().split('=', 1)
-        return {key.strip(): value.strip()}
-    except:
+    """Парсить строку прогресса ffmpeg (bytes), оставляя только нужные ключи"""
+    line = line.strip()
+    if not line.startswith(PROGRESS_KEYS):
         return None
+    key, _, value = line.partition(b'=')
+    return {bytes(key): value.strip()}
 
-def convert_video(input_path, output_path):
-    """Конвертировать видео в MP4 (H.264, AAC)"""
-    # Создаем директорию для выходного файла
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    filename = os.path.basename(input_path)
-    print(f"Конвертация: {input_path} -> {output_path}", flush=True)
-    
-    update_status(
-        active=True,
-        current_file=filename,
-        progress=0,
-        speed=None,
-        eta=None,
-        status="starting"
-    )
-    
-    # Получаем длительность и разрешение видео для расчета прогресса и проверки поддержки QSV
-    duration = None
-    video_width = None
-    video_height = None
+def probe_duration(input_path):
+    """Получить длительность видео через ffprobe"""
     try:
         probe_cmd = [
             'ffprobe', '-v', 'error', 
@@ -117,18 +198,93 @@ def convert_video(input_path, output_path):
         lines = result.stdout.strip().split('\n')
         # ffprobe возвращает значения в порядке: width, height, duration (без префиксов)
         values = [line.strip() for line in lines if line.strip()]
-        if len(values) >= 2:
-            try:
-                video_width = int(values[0])
-                video_height = int(values[1])
-                if len(values) >= 3:
-                    duration = float(values[2])
-            except (ValueError, IndexError):
-                pass
+        if len(values) >= 3:
+            return float(values[2])
     except:
         pass
+    return None
+
+def load_meta():
+    """Загрузить sidecar-кэш метаданных (читается с диска один раз за время работы процесса)"""
+    global _meta
+    if _meta is None:
+        try:
+            with open(META_FILE, 'rb') as f:
+                _meta = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            _meta = {}
+        if not isinstance(_meta, dict):
+            _meta = {}
+    return _meta
+
+def save_meta():
+    """Сохранить sidecar-кэш метаданных"""
+    try:
+        tmp_path = META_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(load_meta()))
+        os.replace(tmp_path, META_FILE)
+    except Exception as e:
+        print(f"Ошибка сохранения метаданных: {e}", flush=True)
+
+def prune_meta(input_paths):
+    """Удалить из sidecar-кэша записи для файлов, которых больше нет во входной директории"""
+    meta = load_meta()
+    stale = meta.keys() - set(input_paths)
+    if stale:
+        for path in stale:
+            del meta[path]
+        save_meta()
+
+def get_cached_duration(input_path, stat):
+    """Получить длительность из xattr или sidecar-файла, если файл не менялся"""
+    try:
+        if int(os.getxattr(input_path, MTIME_XATTR)) == stat.st_mtime_ns:
+            return float(os.getxattr(input_path, DURATION_XATTR))
+    except (OSError, AttributeError, ValueError):
+        pass
+    
+    entry = load_meta().get(input_path)
+    if isinstance(entry, dict) and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+        return entry.get('duration')
+    return None
+
+def store_cached_duration(input_path, stat, duration):
+    """Сохранить длительность в xattr, а если ФС их не поддерживает — в sidecar-файл"""
+    try:
+        os.setxattr(input_path, DURATION_XATTR, f'{duration}'.encode())
+        os.setxattr(input_path, MTIME_XATTR, f'{stat.st_mtime_ns}'.encode())
+        return
+    except (OSError, AttributeError):
+        # Входная директория может быть смонтирована только для чтения
+        pass
+    
+    # Запись по пути входного файла перезаписывается при его изменении
+    load_meta()[input_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'duration': duration}
+    save_meta()
+
+def get_duration(input_path):
+    """Получить длительность видео, используя кэш, чтобы не запускать ffprobe повторно"""
+    try:
+        stat = os.stat(input_path)
+    except OSError:
+        return probe_duration(input_path)
+    
+    duration = get_cached_duration(input_path, stat)
+    if duration is not None:
+        return duration
+    
+    duration = probe_duration(input_path)
+    if duration is not None:
+        store_cached_duration(input_path, stat, duration)
+    return duration
+
+def detect_qsv():
+    """Проверить доступность Intel Quick Sync (определенный результат кэшируется на время работы процесса)"""
+    global _qsv_available
+    if _qsv_available is not None:
+        return _qsv_available
     
-    # Проверяем доступность Quick Sync с подробным выводом
     use_qsv = False
     print("=== Проверка Intel Quick Sync ===", flush=True)
     
@@ -162,6 +318,8 @@ def convert_video(input_path, output_path):
                 print("  Возможные причины:", flush=True)
                 print("  - Образ ffmpeg не собран с поддержкой QSV", flush=True)
                 print("  - Не установлены библиотеки Intel Media SDK", flush=True)
+            # Кэшируем только результат, полученный от ffmpeg; временные сбои проверяем заново
+            _qsv_available = use_qsv
         except Exception as e:
             print(f"✗ Ошибка проверки ffmpeg: {e}", flush=True)
     else:
@@ -173,86 +331,97 @@ def convert_video(input_path, output_path):
         print(">>> Quick Sync НЕ будет использоваться, используется программный кодек <<<", flush=True)
     print("===================================", flush=True)
     
+    return use_qsv
+
+def build_cmd(tmpl, input_path, output_path):
+    """Собрать команду ffmpeg из шаблона, подставив входной и выходной пути"""
+    return [
+        input_path if arg == INPUT_ARG else output_path if arg == OUTPUT_ARG else arg
+        for arg in tmpl
+    ]
+
+def convert_video(input_path, output_path):
+    """Конвертировать видео в MP4 (H.264, AAC)"""
+    # Создаем директорию для выходного файла
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    
+    filename = os.path.basename(input_path)
+    print(f"Конвертация: {input_path} -> {output_path}", flush=True)
+    
+    update_status(
+        active=True,
+        current_file=filename,
+        progress=0,
+        speed=None,
+        eta=None,
+        status="starting",
+        force=True
+    )
+    
+    # Получаем длительность видео для расчета прогресса
+    duration = get_duration(input_path)
+    
+    use_qsv = detect_qsv()
+    
     # Параметры конвертации
     if use_qsv:
         update_status(method="qsv")
-        # Правильное использование QSV для HEVC 4K HDR -> H.264 SDR
-        # Декодируем HEVC через QSV, масштабируем через scale_qsv, кодируем h264_qsv
-        cmd = [
-            'ffmpeg',
-            '-init_hw_device', 'qsv=hw:/dev/dri/renderD128',  # Инициализируем QSV устройство
-            '-filter_hw_device', 'hw',  # Указываем устройство для фильтров
-            '-hwaccel', 'qsv',  # Аппаратное декодирование HEVC через QSV
-            '-hwaccel_output_format', 'qsv',
-            '-i', input_path,
-            '-vf', 'hwupload=extra_hw_frames=64,scale_qsv=1920:1080:format=nv12',  # Масштабирование через QSV (4K -> 1080p, убираем HDR)
-            '-c:v', 'h264_qsv',
-            '-global_quality', '23',  # Качество для QSV (0-51, меньше = лучше)
-            '-profile:v', 'high',
-            '-level', '4.2',  # Уровень для поддержки 1080p
-            '-c:a', 'aac',
-            '-b:a', '192k',
-            '-movflags', '+faststart',
-            '-y',
-            '-progress', 'pipe:1',
-            '-loglevel', 'warning',
-            output_path
-        ]
+        cmd = build_cmd(QSV_CMD_TMPL, input_path, output_path)
     else:
         update_status(method="software")
-        cmd = [
-            'ffmpeg',
-            '-i', input_path,
-            '-c:v', 'libx264',           # Видеокодек H.264
-            '-preset', 'medium',          # Баланс скорости/качества
-            '-crf', '23',                 # Качество (18-28, меньше = лучше)
-            '-c:a', 'aac',                # Аудиокодек AAC
-            '-b:a', '192k',               # Битрейт аудио
-            '-movflags', '+faststart',    # Быстрый старт для веб-плееров
-            '-pix_fmt', 'yuv420p',        # Совместимость с браузерами
-            '-profile:v', 'high',         # Профиль H.264
-            '-level', '4.0',              # Уровень H.264
-            '-y',                         # Перезаписать выходной файл
-            '-progress', 'pipe:1',        # Вывод прогресса в stdout
-            '-loglevel', 'error',         # Минимальный вывод логов
-            output_path
-        ]
+        cmd = build_cmd(SW_CMD_TMPL, input_path, output_path)
     
     try:
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-                                  text=True, bufsize=1)
+                                  bufsize=0)
         
-        update_status(status="converting")
+        update_status(status="converting", force=True)
         
-        # Читаем прогресс из stdout
-        out_time = 0
-        for line in process.stdout:
-            line = line.strip()
-            if not line or '=' not in line:
-                continue
+        # Читаем прогресс из stdout крупными кусками и обрабатываем поблочно:
+        # ffmpeg завершает каждый блок строкой progress=...
+        block = {}
+        buf = bytearray()
+        fd = process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, PROGRESS_READ_SIZE)
+            if not chunk:
+                break
+            buf += chunk
+            *lines, tail = buf.split(b'\n')
+            buf = bytearray(tail)
+            for line in lines:
+                parsed = parse_ffmpeg_progress(line)
+                if not parsed:
+                    continue
+                block.update(parsed)
+                if b'progress' not in parsed:
+                    continue
                 
-            try:
-                if line.startswith('out_time_ms='):
-                    out_time_ms = float(line.split('=', 1)[1])
-                    out_time = out_time_ms / 1000000.0
+                computed = {}
+                out_time = 0
+                try:
+                    out_time = float(block.get(b'out_time_ms', 0)) / 1000000.0
                     if duration and duration > 0:
-                        progress = min(100, int((out_time / duration) * 100))
-                        update_status(progress=progress)
-                elif line.startswith('speed='):
-                    speed_str = line.split('=', 1)[1].replace('x', '').strip()
-                    speed = float(speed_str)
-                    update_status(speed=speed)
+                        computed['progress'] = min(100, int((out_time / duration) * 100))
+                except ValueError:
+                    # Игнорируем ошибки парсинга (например, N/A)
+                    pass
+                try:
+                    speed = float(block.get(b'speed', b'').replace(b'x', b'').strip())
+                    computed['speed'] = speed
                     if duration and speed > 0 and out_time > 0:
-                        remaining = max(0, (duration - out_time) / speed)
-                        update_status(eta=int(remaining))
-            except Exception as e:
-                # Игнорируем ошибки парсинга
-                pass
+                        computed['eta'] = int(max(0, (duration - out_time) / speed))
+                except ValueError:
+                    pass
+            
+                if computed:
+                    update_status(**computed)
+                block.clear()
         
         process.wait()
         
         # Читаем stderr для диагностики ошибок
-        stderr_output = process.stderr.read() if process.stderr else ""
+        stderr_output = process.stderr.read().decode('utf-8', errors='replace') if process.stderr else ""
         if stderr_output and (process.returncode != 0 or 'error' in stderr_output.lower() or 'failed' in stderr_output.lower()):
             print(f"FFmpeg stderr (ошибки): {stderr_output[:2000]}", flush=True)
         
@@ -263,7 +432,8 @@ def convert_video(input_path, output_path):
                 current_file=None,
                 progress=100,
                 status="completed",
-                method=None
+                method=None,
+                force=True
             )
             time.sleep(1)  # Показываем 100% на секунду
             update_status(
@@ -271,7 +441,8 @@ def convert_video(input_path, output_path):
                 current_file=None,
                 progress=0,
                 status="idle",
-                method=None
+                method=None,
+                force=True
             )
             return True
         else:
@@ -284,10 +455,11 @@ def convert_video(input_path, output_path):
             current_file=None,
             progress=0,
             status="error",
-            method=None
+            method=None,
+            force=True
         )
         time.sleep(2)
-        update_status(status="idle", method=None)
+        update_status(status="idle", method=None, force=True)
         return False
     except Exception as e:
         print(f"Неожиданная ошибка: {e}", flush=True)
@@ -296,10 +468,11 @@ def convert_video(input_path, output_path):
             current_file=None,
             progress=0,
             status="error",
-            method=None
+            method=None,
+            force=True
         )
         time.sleep(2)
-        update_status(status="idle", method=None)
+        update_status(status="idle", method=None, force=True)
         return False
 
 def scan_and_convert():
@@ -311,13 +484,34 @@ def scan_and_convert():
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR, exist_ok=True)
     
-    video_files = get_video_files(INPUT_DIR)
+    # Сортируем по алфавиту, чтобы конвертировать в предсказуемом порядке
+    video_files = sorted(get_video_files(INPUT_DIR))
     print(f"Найдено видеофайлов: {len(video_files)}", flush=True)
     
-    for input_path in video_files:
+    # Кэш длительностей не должен расти за счет удаленных файлов
+    prune_meta(video_files)
+    
+    # Один обход выходной директории вместо stat каждого выходного файла
+    out_index = get_output_index(OUTPUT_DIR)
+    
+    def check(input_path):
         output_path = get_output_path(input_path)
-        
-        if needs_conversion(input_path, output_path):
+        try:
+            return input_path, output_path, needs_conversion(input_path, output_path, out_index)
+        except OSError as e:
+            # Файл мог исчезнуть между обходом и проверкой
+            print(f"Пропуск (нет доступа к файлу): {input_path}: {e}", flush=True)
+            return input_path, output_path, None
+    
+    # Проверка метаданных параллельно: на сетевых ФС stat упирается в задержку
+    with concurrent.futures.ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        results = list(executor.map(check, video_files))
+    
+    # Сама конвертация остается последовательной из-за общего статуса
+    for input_path, output_path, needed in results:
+        if needed is None:
+            continue
+        if needed:
             convert_video(input_path, output_path)
         else:
             print(f"Пропуск (уже обработан): {input_path}", flush=True)
@@ -337,7 +531,8 @@ def main():
         speed=None,
         eta=None,
         status="idle",
-        method=None
+        method=None,
+        force=True
     )
     
     # Первоначальное сканирование